@@ -1,17 +1,28 @@
 from contextlib import asynccontextmanager
+import asyncio
+import hashlib
+import logging
+import math
 import os
 import pickle
+import random
+import tempfile
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional ,List , Dict ,Any ,Tuple
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 import httpx
 from fastapi import FastAPI, HTTPException,Query
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 from dotenv import load_dotenv
 from contextlib import asynccontextmanager 
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 TMDB_API_KEY = os.getenv("TMDB_API_KEY")
 TMDB_BASE = "https://api.themoviedb.org/3"
 TMBD_img_500 = "https://image.tmdb.org/t/p/w500"
@@ -32,13 +43,14 @@ DF_PATH = os.path.join(BASE_DIR, "df.pkl")
 INDICES_PATH = os.path.join(BASE_DIR, "indices.pkl")
 TFIDF_MATRIX_PATH = os.path.join(BASE_DIR, "tfidf_matrix.pkl")
 TFIDF_PATH = os.path.join(BASE_DIR, "tfidf.pkl")
+TITLE_STORE_PATH = os.path.join(BASE_DIR, "title_store.npz")
 
 df: Optional[pd.DataFrame] = None
 indices_obj:Any =None
 tfidf_matrix:Any =None
 tfidf_obj:Any =None
 
-TITLE_TO_INDEX: Optional[Dict[str, int]] = None
+TITLE_STORE: Optional["TitleStore"] = None
 
 class TMBDMovieCard(BaseModel):
     id: int
@@ -63,6 +75,24 @@ class   TFIDFRecItem(BaseModel):
     similarity_score: float
     tmbd:Optional[TMBDMovieCard]= None
     
+class ProfileTitle(BaseModel):
+    title: str
+    weight: float = Field(1.0, gt=0, allow_inf_nan=False)
+
+    @field_validator("weight", mode="before")
+    @classmethod
+    def _nonfinite_as_str(cls, v: Any) -> Any:
+        # NaN/Infinity still get rejected by allow_inf_nan=False, but as strings
+        # so the 422 body (which echoes the input) stays valid JSON
+        if isinstance(v, float) and not math.isfinite(v):
+            return str(v)
+        return v
+
+class ProfileRecRequest(BaseModel):
+    titles: List[ProfileTitle] = Field(..., min_length=1, max_length=300)
+    session_id: Optional[str] = None
+    top_n: int = Field(10, ge=1, le=50)
+
 class SearchBundleResponse(BaseModel):
     query: str
     movie_details: TMBDMovieDetail
@@ -78,25 +108,286 @@ def make_img_url(path: Optional[str]) -> Optional[str]:
         return f"{TMBD_img_500}{path}"
     return None
 
+# =========================
+# TMDB CLIENT (rate limit, retries, hedging, circuit breaker)
+# =========================
+TMDB_TIMEOUT = float(os.getenv("TMDB_TIMEOUT", "8"))
+TMDB_DEADLINE = float(os.getenv("TMDB_DEADLINE", "12"))
+TMDB_RATE_PER_SEC = float(os.getenv("TMDB_RATE_PER_SEC", "40"))
+TMDB_BURST = int(os.getenv("TMDB_BURST", "20"))
+TMDB_MAX_RETRIES = int(os.getenv("TMDB_MAX_RETRIES", "3"))
+TMDB_BACKOFF_BASE = float(os.getenv("TMDB_BACKOFF_BASE", "0.25"))
+TMDB_BACKOFF_MAX = float(os.getenv("TMDB_BACKOFF_MAX", "4"))
+TMDB_HEDGE_PERCENTILE = float(os.getenv("TMDB_HEDGE_PERCENTILE", "95"))  # 0 disables hedging
+TMDB_HEDGE_MIN_SAMPLES = 20
+TMDB_BREAKER_FAILURES = int(os.getenv("TMDB_BREAKER_FAILURES", "5"))
+TMDB_BREAKER_COOLDOWN = float(os.getenv("TMDB_BREAKER_COOLDOWN", "30"))
+TMDB_STALE_MAX_ITEMS = int(os.getenv("TMDB_STALE_MAX_ITEMS", "1024"))
+TMDB_STALE_MAX_AGE = float(os.getenv("TMDB_STALE_MAX_AGE", "3600"))
+
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """
+    Client-side limiter so we stay under TMDB's per-IP request rate
+    instead of finding out through 429s.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if time.monotonic() >= self.paused_until and self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        # honour Retry-After for every caller, not just the one that got the 429
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class LatencyTracker:
+    """Rolling window of successful TMDB latencies, used to pick the hedge delay."""
+
+    def __init__(self, size: int = 200):
+        self.samples: deque = deque(maxlen=size)
+
+    def record(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if len(self.samples) < TMDB_HEDGE_MIN_SAMPLES:
+            return None
+        return float(np.percentile(np.fromiter(self.samples, dtype=float), pct))
+
+
+class CircuitBreaker:
+    """
+    closed    -> requests flow, consecutive failures are counted
+    open      -> fail fast until the cooldown expires
+    half_open -> a single probe is let through; success closes, failure re-opens
+    """
+
+    def __init__(self, max_failures: int, cooldown: float):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_started = 0.0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state = "half_open"
+        if self.state == "half_open" and time.monotonic() - self.probe_started >= self.cooldown:
+            # a probe that never reported back is given up on after one cooldown
+            self.probe_started = time.monotonic()
+            return True
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.state = "closed"
+        self.probe_started = 0.0
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self.probe_started = 0.0
+        if self.state == "half_open" or self.failures >= self.max_failures:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+
+TMDB_BUCKET = TokenBucket(TMDB_RATE_PER_SEC, TMDB_BURST)
+TMDB_LATENCY = LatencyTracker()
+TMDB_BREAKER = CircuitBreaker(TMDB_BREAKER_FAILURES, TMDB_BREAKER_COOLDOWN)
+# (stored_at, last good response) per (path, params); served while TMDB is unhealthy
+TMDB_STALE: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_TMDB_CLIENT: Optional[httpx.AsyncClient] = None
+
+
+def _tmdb_client() -> httpx.AsyncClient:
+    global _TMDB_CLIENT
+    if _TMDB_CLIENT is None or _TMDB_CLIENT.is_closed:
+        _TMDB_CLIENT = httpx.AsyncClient(timeout=TMDB_TIMEOUT)
+    return _TMDB_CLIENT
+
+
+def _stale_key(path: str, params: Dict[str, Any]) -> Tuple[str, str]:
+    return path, repr(sorted(params.items()))
+
+
+def _stale_put(key: Tuple[str, str], data: Dict[str, Any]) -> None:
+    TMDB_STALE[key] = (time.monotonic(), data)
+    TMDB_STALE.move_to_end(key)
+    while len(TMDB_STALE) > TMDB_STALE_MAX_ITEMS:
+        TMDB_STALE.popitem(last=False)
+
+
+def _stale_get(key: Tuple[str, str], reason: str) -> Optional[Dict[str, Any]]:
+    """Last good response if it is younger than TMDB_STALE_MAX_AGE; logged when used."""
+    entry = TMDB_STALE.get(key)
+    if entry is None:
+        return None
+    age = time.monotonic() - entry[0]
+    if age > TMDB_STALE_MAX_AGE:
+        del TMDB_STALE[key]
+        return None
+    logger.warning("Serving stale TMDB response for %s (%s, age %.0fs)", key[0], reason, age)
+    return entry[1]
+
+
+def _backoff_delay(attempt: int) -> float:
+    # full jitter: uniform(0, min(cap, base * 2^attempt))
+    return random.uniform(0, min(TMDB_BACKOFF_MAX, TMDB_BACKOFF_BASE * (2 ** attempt)))
+
+
+def _retry_after_seconds(r: httpx.Response) -> Optional[float]:
+    value = r.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+async def _tmdb_send(url: str, q: Dict[str, Any]) -> httpx.Response:
+    await TMDB_BUCKET.acquire()
+    start = time.monotonic()
+    r = await _tmdb_client().get(url, params=q)
+    if r.status_code == 200:
+        TMDB_LATENCY.record(time.monotonic() - start)
+    return r
+
+
+async def _tmdb_send_hedged(url: str, q: Dict[str, Any]) -> httpx.Response:
+    """
+    GET with an optional hedge: if the first request is slower than the
+    recent p{TMDB_HEDGE_PERCENTILE} latency, fire a second one and take
+    whichever answers first. The hedge is skipped when the bucket is empty
+    so hedging never pushes us over the rate limit.
+    """
+    hedge_after = TMDB_LATENCY.percentile(TMDB_HEDGE_PERCENTILE) if TMDB_HEDGE_PERCENTILE > 0 else None
+    primary = asyncio.ensure_future(_tmdb_send(url, q))
+    pending = {primary}
+    try:
+        if hedge_after is None:
+            return await primary
+
+        done, _ = await asyncio.wait(pending, timeout=hedge_after)
+        if done or not TMDB_BUCKET.try_acquire():
+            return await primary
+
+        pending.add(asyncio.ensure_future(_tmdb_client().get(url, params=q)))
+        error: Optional[BaseException] = None
+        fallback: Optional[httpx.Response] = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    continue
+                r = task.result()
+                # a fast 429/5xx must not cancel the other request, which may still succeed
+                if r.status_code not in RETRYABLE_STATUS:
+                    return r
+                fallback = r
+        if fallback is not None:
+            return fallback
+        raise error  # both attempts failed
+    finally:
+        for task in pending:
+            task.cancel()
+
+
 async def tmbd_get(path :str, params: Dict[str, Any]={}) -> Dict[str, Any]:
     """
-    Safe TMBD GET
+    Resilient TMBD GET
+    - client-side token bucket, Retry-After honoured on 429
+    - jittered exponential retries on network errors / 429 / 5xx
+    - hedged request after the recent latency percentile
+    - circuit breaker: while open, serve the last good response (up to
+      TMDB_STALE_MAX_AGE old, logged) or fail fast (503)
+    Once retries are exhausted the same stale copy is tried, otherwise the old mapping:
     - Network errors -> 502
     -TmDB errors -> 500
-
-    
     """
     q = dict(params)
     q["api_key"] = TMDB_API_KEY
-    try:
-        async with httpx.AsyncClient(timeout=20) as client:
-            r= await client.get(f"{TMDB_BASE}{path}", params=q)
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=502, detail=f"Network error: {str(e)}")  
-    
-    if r.status_code != 200:
-        raise HTTPException(status_code=500, detail=f"TMDB API error: {r.text}")
-    return r.json()
+    url = f"{TMDB_BASE}{path}"
+    key = _stale_key(path, params)
+
+    if not TMDB_BREAKER.allow():
+        stale = _stale_get(key, "circuit open")
+        if stale is not None:
+            return stale
+        raise HTTPException(status_code=503, detail="TMDB temporarily unavailable")
+
+    deadline = time.monotonic() + TMDB_DEADLINE
+    error: HTTPException
+    for attempt in range(TMDB_MAX_RETRIES + 1):
+        delay = _backoff_delay(attempt)
+        try:
+            r = await asyncio.wait_for(
+                _tmdb_send_hedged(url, q), timeout=max(0.0, deadline - time.monotonic())
+            )
+        except (httpx.RequestError, asyncio.TimeoutError) as e:
+            error = HTTPException(status_code=502, detail=f"Network error: {str(e)}")
+        else:
+            if r.status_code == 200:
+                TMDB_BREAKER.record_success()
+                data = r.json()
+                _stale_put(key, data)
+                return data
+            error = HTTPException(status_code=500, detail=f"TMDB API error: {r.text}")
+            if r.status_code not in RETRYABLE_STATUS:
+                # upstream is healthy, the request itself is bad -> no retry
+                TMDB_BREAKER.record_success()
+                raise error
+            if r.status_code == 429:
+                retry_after = _retry_after_seconds(r)
+                if retry_after is not None:
+                    TMDB_BUCKET.pause(retry_after)
+                    delay = retry_after
+
+        if attempt == TMDB_MAX_RETRIES or time.monotonic() + delay >= deadline:
+            break
+        await asyncio.sleep(delay)
+
+    TMDB_BREAKER.record_failure()
+    stale = _stale_get(key, f"retries exhausted: {error.status_code}")
+    if stale is not None:
+        return stale
+    raise error
  
 async def tmbd_cards_from_results(results: List[Dict],limit: int = 20 ) -> List[TMBDMovieCard]:
     out : list[TMBDMovieCard] = []
@@ -151,7 +442,7 @@ def build_title_to_idx_map(indices: Any) -> Dict[str, int]:
     indices.pkl can be:
     - dict(title -> index)
     - pandas Series (index=title, value=index)
-    We normalize into TITLE_TO_IDX.
+    We normalize into a title -> index dict (input to TitleStore.build).
     """
     title_to_idx: Dict[str, int] = {}
 
@@ -172,52 +463,376 @@ def build_title_to_idx_map(indices: Any) -> Dict[str, int]:
         )
         
         
+def _title_hash(key: str) -> int:
+    # stable across processes (unlike hash()), so it can be saved to disk
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class TitleStore:
+    """
+    Array-backed replacement for the title dict + df.iloc lookups:
+    - blob/offsets: row i's output title is blob[offsets[i]:offsets[i + 1]] (UTF-8)
+    - hashes/rows:  sorted 64-bit hashes of normalized titles, parallel row indices
+    A handful of numpy arrays instead of one Python str/int per title.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray, hashes: np.ndarray, rows: np.ndarray):
+        self.blob = blob
+        self.offsets = offsets
+        self.hashes = hashes
+        self.rows = rows
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def title(self, i: int) -> str:
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf-8")
+
+    def lookup(self, title: str) -> Optional[int]:
+        h = np.uint64(_title_hash(_norm_title(title)))
+        pos = int(np.searchsorted(self.hashes, h))
+        if pos < len(self.hashes) and self.hashes[pos] == h:
+            return int(self.rows[pos])
+        return None
+
+    @classmethod
+    def build(cls, titles: Any, indices: Any) -> "TitleStore":
+        """titles: output title per row (df["title"]); indices: as accepted by build_title_to_idx_map."""
+        encoded = [str(t).encode("utf-8") for t in titles]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+        # same "last one wins" semantics as the old dict for duplicate titles
+        by_hash = {_title_hash(k): v for k, v in build_title_to_idx_map(indices).items()}
+        hashes = np.fromiter(by_hash.keys(), dtype=np.uint64, count=len(by_hash))
+        rows = np.fromiter(by_hash.values(), dtype=np.int64, count=len(by_hash))
+        order = np.argsort(hashes)
+        return cls(blob, offsets, hashes[order], rows[order])
+
+    def save(self, path: str) -> None:
+        # temp file + os.replace, so other workers never see a half-written store
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), prefix=os.path.basename(path) + ".", suffix=".tmp"
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, blob=self.blob, offsets=self.offsets, hashes=self.hashes, rows=self.rows)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @classmethod
+    def load(cls, path: str) -> "TitleStore":
+        with np.load(path, allow_pickle=False) as z:
+            return cls(z["blob"], z["offsets"], z["hashes"], z["rows"])
+
+
 def get_local_idx_by_title(title: str) -> int:
-    global TITLE_TO_IDX
-    if TITLE_TO_IDX is None:
+    global TITLE_STORE
+    if TITLE_STORE is None:
         raise HTTPException(status_code=500, detail="TF-IDF index map not initialized")
-    key = _norm_title(title)
-    if key in TITLE_TO_IDX:
-        return int(TITLE_TO_IDX[key])
+    idx = TITLE_STORE.lookup(title)
+    if idx is not None:
+        return idx
     raise HTTPException(
         status_code=404, detail=f"Title not found in local dataset: '{title}'"
     )
     
     
-def tfidf_recommend_titles(
-    query_title: str, top_n: int = 10
+def _rank_titles(
+    scores: np.ndarray, exclude: Any, top_n: int
 ) -> List[Tuple[str, float]]:
     """
-    Returns list of (title, score) from local df using cosine similarity on TF-IDF matrix.
-    Safe against missing columns/rows.
+    Top-N (title, score) from a full-catalog score vector, skipping `exclude` indices.
+    Only the top_n + len(exclude) candidates are sorted, not the whole catalog.
     """
-    global df, tfidf_matrix
-    if df is None or tfidf_matrix is None:
-        raise HTTPException(status_code=500, detail="TF-IDF resources not loaded")
-
-    idx = get_local_idx_by_title(query_title)
-
-    # query vector
-    qv = tfidf_matrix[idx]
-    scores = (tfidf_matrix @ qv.T).toarray().ravel()
-
-    # sort descending
-    order = np.argsort(-scores)
+    k = min(len(scores), top_n + len(exclude))
+    if k <= 0:
+        return []
+    top = np.argpartition(-scores, k - 1)[:k]
+    order = top[np.argsort(-scores[top])]
 
     out: List[Tuple[str, float]] = []
     for i in order:
-        if int(i) == int(idx):
-            continue
-        try:
-            title_i = str(df.iloc[int(i)]["title"])
-        except Exception:
+        if int(i) in exclude or int(i) >= len(TITLE_STORE):
             continue
+        title_i = TITLE_STORE.title(int(i))
         out.append((title_i, float(scores[int(i)])))
         if len(out) >= top_n:
             break
     return out
 
 
+# =========================
+# WATCH-HISTORY PROFILES
+# =========================
+PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", "1000"))
+# total stored entries (profile nnz + history length) across all sessions
+PROFILE_CACHE_MAX_NNZ = int(os.getenv("PROFILE_CACHE_MAX_NNZ", "2000000"))
+
+# session_id -> {"weights": {row idx -> weight}, "vector": 1 x V sparse profile, "nnz": size}
+PROFILE_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_profile_cache_nnz = 0
+
+
+def _weighted_rows(weights: Dict[int, float]) -> Any:
+    """Sum of weight * tfidf_matrix[idx] as a single 1 x V sparse row."""
+    n = tfidf_matrix.shape[0]
+    idxs = np.fromiter(weights.keys(), dtype=np.int64, count=len(weights))
+    vals = np.fromiter(weights.values(), dtype=np.float64, count=len(weights))
+    selector = sp.csr_matrix((vals, (np.zeros(len(idxs), dtype=np.int64), idxs)), shape=(1, n))
+    return sp.csr_matrix(selector @ tfidf_matrix)
+
+
+def build_profile_vector(
+    weights: Dict[int, float], session_id: Optional[str] = None
+) -> Any:
+    """
+    Profile = weighted sum of the TF-IDF rows in the history.
+    With a session_id the vector is cached (LRU) and later calls only add
+    the rows whose weight changed, so growing a history by one title costs
+    one row instead of a rebuild. The cache is bounded by entry count and
+    by total stored nnz.
+    """
+    global _profile_cache_nnz
+    if session_id is None:
+        return _weighted_rows(weights)
+
+    cached = PROFILE_CACHE.get(session_id)
+    if cached is None:
+        vector = _weighted_rows(weights)
+    else:
+        old = cached["weights"]
+        delta = {
+            i: weights.get(i, 0.0) - old.get(i, 0.0)
+            for i in set(old) | set(weights)
+            if weights.get(i, 0.0) != old.get(i, 0.0)
+        }
+        vector = cached["vector"]
+        if delta:
+            vector = vector + _weighted_rows(delta)
+            vector.eliminate_zeros()
+        _profile_cache_nnz -= cached["nnz"]
+
+    nnz = int(vector.nnz) + len(weights)
+    PROFILE_CACHE[session_id] = {"weights": dict(weights), "vector": vector, "nnz": nnz}
+    PROFILE_CACHE.move_to_end(session_id)
+    _profile_cache_nnz += nnz
+    while PROFILE_CACHE and (
+        len(PROFILE_CACHE) > PROFILE_CACHE_SIZE or _profile_cache_nnz > PROFILE_CACHE_MAX_NNZ
+    ):
+        _, evicted = PROFILE_CACHE.popitem(last=False)
+        _profile_cache_nnz -= evicted["nnz"]
+    return vector
+
+
+def _score_profile(profile: Any, exclude: Any, top_n: int) -> List[Tuple[str, float]]:
+    """Full-catalog product + ranking for one profile vector (runs on the similarity pool)."""
+    norm = float(np.sqrt(profile.multiply(profile).sum()))
+    if norm == 0.0:
+        return []
+    # rows are L2-normalized, so dividing by |profile| keeps scores on the cosine scale
+    scores = (tfidf_matrix @ profile.T).toarray().ravel() / norm
+
+    return _rank_titles(scores, exclude, top_n)
+
+
+async def profile_recommend_titles(
+    history: List[ProfileTitle], top_n: int = 10, session_id: Optional[str] = None
+) -> List[Tuple[str, float]]:
+    """
+    Returns list of (title, score) for a whole watch history: one sparse product
+    of the catalog against the profile vector, already-seen titles excluded.
+    Unknown titles are skipped; 404 only if none of them are in the local dataset.
+    The profile cache is only touched here on the event loop; the scoring runs
+    on the similarity pool.
+    """
+    global TITLE_STORE, tfidf_matrix
+    if TITLE_STORE is None or tfidf_matrix is None:
+        raise HTTPException(status_code=500, detail="TF-IDF resources not loaded")
+
+    weights: Dict[int, float] = {}
+    for item in history:
+        try:
+            idx = get_local_idx_by_title(item.title)
+        except HTTPException:
+            continue
+        weights[idx] = weights.get(idx, 0.0) + float(item.weight)
+
+    if not weights:
+        raise HTTPException(
+            status_code=404, detail="None of the given titles are in the local dataset"
+        )
+
+    profile = build_profile_vector(weights, session_id=session_id)
+    return await asyncio.get_running_loop().run_in_executor(
+        SIMILARITY.pool, _score_profile, profile, set(weights), top_n
+    )
+
+
+# =========================
+# SIMILARITY EXECUTOR (micro-batching, off the event loop)
+# =========================
+SIM_BATCH_MAX_SIZE = int(os.getenv("SIM_BATCH_MAX_SIZE", "32"))
+SIM_BATCH_WAIT_MS = float(os.getenv("SIM_BATCH_WAIT_MS", "2"))
+SIM_WORKERS = int(os.getenv("SIM_WORKERS", "1"))
+
+
+def _batch_recommend(
+    jobs: List[Tuple[int, int]]
+) -> List[List[Tuple[str, float]]]:
+    """
+    jobs: list of (row idx, top_n). One stacked sparse product for the whole
+    batch: (N x V) @ (V x k) -> N x k scores, one column per distinct idx.
+    """
+    uniq = sorted({idx for idx, _ in jobs})
+    col = {idx: j for j, idx in enumerate(uniq)}
+    scores = (tfidf_matrix @ tfidf_matrix[uniq].T).toarray()
+    return [_rank_titles(scores[:, col[idx]], {idx}, top_n) for idx, top_n in jobs]
+
+
+class SimilarityBatcher:
+    """
+    Queues concurrent similarity queries and runs everything that arrives
+    within `wait_ms` (up to `max_batch` queries) as one product on a worker
+    thread, then resolves each caller's future.
+    """
+
+    def __init__(self, max_batch: int, wait_ms: float, workers: int):
+        self.max_batch = max_batch
+        self.wait = wait_ms / 1000.0
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="similarity")
+        self.queue: Optional[asyncio.Queue] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._worker: Optional[asyncio.Task] = None
+        self._in_flight: set = set()
+        self.stats = {"requests": 0, "batches": 0, "max_queue_depth": 0, "last_batch_size": 0}
+
+    def _ensure_started(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._worker is not None and not self._worker.done():
+            return
+        if self._loop is not loop:
+            # a queue from another (finished) loop can't be awaited here; fail what's left in it
+            if self.queue is not None:
+                self._fail_queued(RuntimeError("similarity executor restarted on a new event loop"))
+            self.queue = asyncio.Queue()
+            self._loop = loop
+        # same loop: keep the queue so jobs already in it get picked up by the new worker
+        self._worker = loop.create_task(self._run())
+
+    def _fail_queued(self, exc: BaseException) -> None:
+        while not self.queue.empty():
+            _, _, fut = self.queue.get_nowait()
+            self._fail([fut], exc)
+
+    @staticmethod
+    def _fail(futures: List[asyncio.Future], exc: BaseException) -> None:
+        for fut in futures:
+            if not fut.done():
+                try:
+                    fut.set_exception(exc)
+                except RuntimeError:
+                    pass  # its loop is already closed
+
+    async def submit(self, idx: int, top_n: int) -> List[Tuple[str, float]]:
+        self._ensure_started()
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((idx, top_n, fut))
+        self.stats["requests"] += 1
+        self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], self.queue.qsize())
+        return await fut
+
+    async def _run(self) -> None:
+        """
+        Collects batches and hands them to the pool without waiting for the
+        result, keeping up to `workers` batches in flight. While every worker
+        is busy, queries keep queuing and the next batch comes out bigger.
+        """
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.workers)
+        batch: List[Tuple[int, int, asyncio.Future]] = []
+        try:
+            while True:
+                await slots.acquire()
+                batch = [await self.queue.get()]
+                deadline = loop.time() + self.wait
+                while len(batch) < self.max_batch:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+                # callers that went away (client disconnect) don't need computing
+                batch = [job for job in batch if not job[2].done()]
+                if not batch:
+                    slots.release()
+                    continue
+                self.stats["batches"] += 1
+                self.stats["last_batch_size"] = len(batch)
+                task = loop.create_task(self._dispatch(batch, slots))
+                self._in_flight.add(task)
+                task.add_done_callback(self._in_flight.discard)
+                batch = []
+        except BaseException as e:
+            # nobody will pick these up any more; don't leave their callers awaiting forever
+            exc = e if isinstance(e, Exception) else RuntimeError("similarity executor stopped")
+            self._fail([fut for _, _, fut in batch], exc)
+            self._fail_queued(exc)
+            raise
+
+    async def _dispatch(self, batch: List[Tuple[int, int, asyncio.Future]], slots: asyncio.Semaphore) -> None:
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self.pool, _batch_recommend, [(idx, top_n) for idx, top_n, _ in batch]
+            )
+        except Exception as e:
+            self._fail([fut for _, _, fut in batch], e)
+            return
+        finally:
+            slots.release()
+        for (_, _, fut), res in zip(batch, results):
+            if not fut.done():
+                fut.set_result(res)
+
+    def metrics(self) -> Dict[str, Any]:
+        out = dict(self.stats)
+        out["queue_depth"] = self.queue.qsize() if self.queue is not None else 0
+        out["avg_batch_size"] = (
+            out["requests"] / out["batches"] if out["batches"] else 0.0
+        )
+        out["batches_in_flight"] = len(self._in_flight)
+        out["workers"] = self.workers
+        out["max_batch_size"] = self.max_batch
+        out["wait_ms"] = self.wait * 1000.0
+        return out
+
+
+SIMILARITY = SimilarityBatcher(SIM_BATCH_MAX_SIZE, SIM_BATCH_WAIT_MS, SIM_WORKERS)
+
+
+async def tfidf_recommend_titles(
+    query_title: str, top_n: int = 10
+) -> List[Tuple[str, float]]:
+    """
+    Returns list of (title, score) from the local title store using cosine similarity on TF-IDF matrix.
+    Goes through SIMILARITY, so it is batched with concurrent queries and computed off the event loop.
+    """
+    global TITLE_STORE, tfidf_matrix
+    if TITLE_STORE is None or tfidf_matrix is None:
+        raise HTTPException(status_code=500, detail="TF-IDF resources not loaded")
+
+    idx = get_local_idx_by_title(query_title)
+    return await SIMILARITY.submit(int(idx), top_n)
+
+
 async def attach_tmdb_card_by_title(title: str) -> Optional[TMBDMovieCard]:
     """
     Uses TMDB search by title to fetch poster for a local title.
@@ -244,21 +859,48 @@ async def attach_tmdb_card_by_title(title: str) -> Optional[TMBDMovieCard]:
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup: Load your pickles (moved from load_pickles)
-    global df, indices_obj, tfidf_matrix, tfidf_obj, TITLE_TO_IDX
+    global df, indices_obj, tfidf_matrix, tfidf_obj, TITLE_STORE
     
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))
     DF_PATH = os.path.join(BASE_DIR, "df.pkl")
     INDICES_PATH = os.path.join(BASE_DIR, "indices.pkl")
     TFIDF_MATRIX_PATH = os.path.join(BASE_DIR, "tfidf_matrix.pkl")
     TFIDF_PATH = os.path.join(BASE_DIR, "tfidf.pkl")
+    TITLE_STORE_PATH = os.path.join(BASE_DIR, "title_store.npz")
     
-    # Load df
-    with open(DF_PATH, "rb") as f:
-        df = pickle.load(f)
-    
-    # Load indices
-    with open(INDICES_PATH, "rb") as f:
-        indices_obj = pickle.load(f)
+    # Title store: built once from df + indices, then served without the DataFrame
+    sources = [p for p in (DF_PATH, INDICES_PATH) if os.path.exists(p)]
+    store_fresh = os.path.exists(TITLE_STORE_PATH) and all(
+        os.path.getmtime(TITLE_STORE_PATH) >= os.path.getmtime(p) for p in sources
+    )
+    TITLE_STORE = None
+    if store_fresh:
+        try:
+            TITLE_STORE = TitleStore.load(TITLE_STORE_PATH)
+        except Exception as e:
+            logger.warning("Could not load %s, rebuilding: %s", TITLE_STORE_PATH, e)
+    if TITLE_STORE is None:
+        # Load df
+        with open(DF_PATH, "rb") as f:
+            df = pickle.load(f)
+        
+        # Load indices
+        with open(INDICES_PATH, "rb") as f:
+            indices_obj = pickle.load(f)
+        
+        # Sanity check
+        if df is None or "title" not in df.columns:
+            raise RuntimeError("df.pkl must contain a DataFrame with a 'title' column")
+        
+        TITLE_STORE = TitleStore.build(df["title"], indices_obj)
+        try:
+            TITLE_STORE.save(TITLE_STORE_PATH)
+        except OSError as e:
+            # e.g. read-only app dir: keep serving from the in-memory store
+            logger.warning("Could not save %s: %s", TITLE_STORE_PATH, e)
+        # not needed on the serving path any more
+        df = None
+        indices_obj = None
     
     # Load TF-IDF matrix
     with open(TFIDF_MATRIX_PATH, "rb") as f:
@@ -268,13 +910,6 @@ async def lifespan(app: FastAPI):
     with open(TFIDF_PATH, "rb") as f:
         tfidf_obj = pickle.load(f)
     
-    # Build normalized map
-    TITLE_TO_IDX = build_title_to_idx_map(indices_obj)
-    
-    # Sanity check
-    if df is None or "title" not in df.columns:
-        raise RuntimeError("df.pkl must contain a DataFrame with a 'title' column")
-    
     
   
   
@@ -286,6 +921,11 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics/similarity")
+def similarity_metrics():
+    return SIMILARITY.metrics()
+
+
 # ---------- HOME FEED (TMDB) ----------
 @app.get("/home", response_model=List[TMBDMovieCard])
 async def home(
@@ -372,7 +1012,18 @@ async def recommend_tfidf(
     title: str = Query(..., min_length=1),
     top_n: int = Query(10, ge=1, le=50),
 ):
-    recs = tfidf_recommend_titles(title, top_n=top_n)
+    recs = await tfidf_recommend_titles(title, top_n=top_n)
+    return [{"title": t, "score": s} for t, s in recs]
+
+
+# ---------- WATCH-HISTORY PROFILE (TF-IDF) ----------
+@app.post("/recommend/profile")
+async def recommend_profile(req: ProfileRecRequest):
+    """
+    Personalized recs from a list of watched/liked titles (optional weights).
+    Pass a stable session_id so the profile vector is cached between calls.
+    """
+    recs = await profile_recommend_titles(req.titles, top_n=req.top_n, session_id=req.session_id)
     return [{"title": t, "score": s} for t, s in recs]
 
 
@@ -408,11 +1059,11 @@ async def search_bundle(
     recs: List[Tuple[str, float]] = []
     try:
         # try local dataset by TMDB title
-        recs = tfidf_recommend_titles(details.title, top_n=tfidf_top_n)
+        recs = await tfidf_recommend_titles(details.title, top_n=tfidf_top_n)
     except Exception:
         # fallback to user query
         try:
-            recs = tfidf_recommend_titles(query, top_n=tfidf_top_n)
+            recs = await tfidf_recommend_titles(query, top_n=tfidf_top_n)
         except Exception:
             recs = []
 